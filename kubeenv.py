@@ -13,6 +13,16 @@ import click
 import random
 import string
 import getpass
+import json
+import fnmatch
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 
 ##############
@@ -47,6 +57,8 @@ def UniqueImageList(images):
 
 directories_schema = voluptuous.Schema({ Required('kubernetes-configs'): str
                                        , Required('deployments'): str
+                                       , Optional('include', default=['*.yaml', '*.yml']): [str]
+                                       , Optional('exclude', default=[]): [str]
                                        })
 
 
@@ -117,6 +129,28 @@ class KubeEnv(click.ParamType):
 
 
 
+class KubeEnvList(click.ParamType):
+
+    name = 'kube-env environment list'
+
+    def __init__(self, base_dir=None, filename=None):
+        self.env_type = KubeEnv(base_dir, filename)
+
+
+    def convert(self, value, param, ctx):
+        envs = []
+        for name in value.split(","):
+            name = name.strip()
+            if name and name not in [env["name"] for env in envs]:
+                envs.append(self.env_type.convert(name, param, ctx))
+
+        if not envs:
+            self.fail('{value} does not name any deployments'.format(value=value), param, ctx)
+
+        return envs
+
+
+
 class Image(click.ParamType):
 
     name = 'kube-env image'
@@ -161,6 +195,192 @@ class Image(click.ParamType):
 
 
 
+INDEX_FILENAME = ".kube-env-index.json"
+
+
+def glob_matches(rel_path, patterns):
+    for pattern in patterns:
+        if fnmatch.fnmatch(rel_path, pattern) or fnmatch.fnmatch(os.path.basename(rel_path), pattern):
+            return True
+    return False
+
+
+class ManifestIndex(object):
+    """
+    Recursive listing of the manifests under dirs.kubernetes-configs.
+    The listing of every directory is saved to INDEX_PATH with its mtime;
+    a directory's mtime changes whenever an entry is added, removed or
+    renamed in it, so only directories whose mtime moved (and any new
+    subdirectories) are listed again, and the rest of the tree is reused.
+    """
+
+    VERSION = 2
+
+    def __init__(self, kube_dir, index_path, include=None, exclude=None):
+        self.kube_dir = kube_dir
+        self.index_path = index_path
+        self.include = include if include is not None else ['*.yaml', '*.yml']
+        self.exclude = exclude if exclude is not None else []
+        self.dirty = False
+
+        self.index = self.refresh(self.load())
+
+        self.names = {}
+        for rel_path in self.index["files"]:
+            stem = os.path.splitext(rel_path)[0]
+            base = os.path.basename(rel_path)
+            for name in set([rel_path, stem, base, os.path.splitext(base)[0]]):
+                if name in self.names and self.names[name] != rel_path:
+                    # Ambiguous short name, only the full relative path works.
+                    self.names[name] = None
+                else:
+                    self.names[name] = rel_path
+        for rel_path in self.index["files"]:
+            self.names[rel_path] = rel_path
+
+
+    def load(self):
+        """
+        The saved index, or an empty one if it is missing or was built
+        for a different directory or set of globs.
+        """
+        empty = { "version": self.VERSION
+                , "root": self.kube_dir
+                , "include": self.include
+                , "exclude": self.exclude
+                , "dirs": {}
+                , "files": []
+                , "meta": {}
+                }
+        try:
+            with open(self.index_path) as INDEX:
+                index = json.load(INDEX)
+        except (IOError, OSError, ValueError):
+            return empty
+
+        if (index.get("version") != self.VERSION
+                or index.get("root") != self.kube_dir
+                or index.get("include") != self.include
+                or index.get("exclude") != self.exclude):
+            return empty
+        return index
+
+
+    def list_dir(self, rel_dir, mtime):
+        subdirs = []
+        files = []
+        for item in sorted(os.listdir(os.path.join(self.kube_dir, rel_dir))):
+            rel_path = os.path.normpath(os.path.join(rel_dir, item))
+            if os.path.isdir(os.path.join(self.kube_dir, rel_path)):
+                if not glob_matches(rel_path, self.exclude):
+                    subdirs.append(rel_path)
+            elif glob_matches(rel_path, self.include) and not glob_matches(rel_path, self.exclude):
+                files.append(rel_path)
+
+        return {"mtime": mtime, "subdirs": subdirs, "files": files}
+
+
+    def refresh(self, index):
+        """
+        Bring INDEX up to date with the tree, re-listing only directories
+        whose mtime changed and keeping the cached kinds and labels of every
+        file that is still there.
+        """
+        dirs = {}
+        files = []
+        pending = ["."]
+        while pending:
+            rel_dir = pending.pop()
+            try:
+                mtime = os.stat(os.path.join(self.kube_dir, rel_dir)).st_mtime
+            except OSError:
+                continue
+
+            entry = index["dirs"].get(rel_dir)
+            if entry is None or entry["mtime"] != mtime:
+                entry = self.list_dir(rel_dir, mtime)
+                self.dirty = True
+
+            dirs[rel_dir] = entry
+            files.extend(entry["files"])
+            pending.extend(reversed(entry["subdirs"]))
+
+        if set(dirs) != set(index["dirs"]):
+            self.dirty = True
+
+        present = set(files)
+        index["dirs"] = dirs
+        index["files"] = files
+        index["meta"] = dict((rel_path, meta) for rel_path, meta in index["meta"].items() if rel_path in present)
+        return index
+
+
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            index_dir = os.path.dirname(self.index_path)
+            if index_dir and not os.path.exists(index_dir):
+                os.makedirs(index_dir)
+            with open(self.index_path, "w") as INDEX:
+                json.dump(self.index, INDEX)
+            self.dirty = False
+        except (IOError, OSError):
+            pass
+
+
+    def files(self):
+        return list(self.index["files"])
+
+
+    def resolve(self, name):
+        """
+        Relative path of the manifest called NAME, None if there is no such
+        manifest and False if NAME is shared by manifests in several directories.
+        """
+        if name not in self.names:
+            return None
+        if self.names[name] is None:
+            return False
+        return self.names[name]
+
+
+    def objects(self, rel_path):
+        """
+        [kind, labels] for every document in REL_PATH, cached by file mtime.
+        """
+        src = os.path.join(self.kube_dir, rel_path)
+        mtime = os.stat(src).st_mtime
+        meta = self.index["meta"].get(rel_path)
+        if meta is not None and meta["mtime"] == mtime:
+            return meta["objects"]
+
+        objects = []
+        with open(src) as SRC:
+            for doc in yaml.load_all(SRC):
+                if isinstance(doc, dict):
+                    labels = (doc.get("metadata") or {}).get("labels") or {}
+                    objects.append([doc.get("kind"), labels])
+
+        self.index["meta"][rel_path] = {"mtime": mtime, "objects": objects}
+        self.dirty = True
+        return objects
+
+
+    def select(self, kind=None, labels=None):
+        selected = []
+        for rel_path in self.index["files"]:
+            for obj_kind, obj_labels in self.objects(rel_path):
+                if kind is not None and obj_kind != kind:
+                    continue
+                if labels is not None and any(str(obj_labels.get(k)) != v for k, v in labels.items()):
+                    continue
+                selected.append(rel_path)
+                break
+        return selected
+
+
+
 class KubeFile(click.ParamType):
 
     name = 'kube-env kube-config'
@@ -183,50 +403,71 @@ class KubeFile(click.ParamType):
             with open(os.path.join(self.base_dir, self.filename)) as KUBEENV:
                 config = yaml.load(KUBEENV.read())
                 config_schema(config)
+        except IOError:
+            self.fail('There is no {filename}.yaml config in {base}'.format(
+                filename=self.filename, base=self.base_dir), param, ctx)
 
-                kube_dir = config["kube-env"]["dirs"]["kubernetes-configs"]
-                deploy_dir = config["kube-env"]["dirs"]["deployments"]
-
-                files = []
-                for item in os.listdir(kube_dir):
-                    source_item = os.path.join(kube_dir, item)
-
-                    if os.path.isfile(source_item) and (source_item.endswith("yaml") or source_item.endswith("yml")):
-                        deployments = []
-                        for deployment in config["kube-env"]["deployments"]:
+        dirs = config["kube-env"]["dirs"]
+        kube_dir = dirs["kubernetes-configs"]
+        deploy_dir = dirs["deployments"]
 
+        index = ManifestIndex( kube_dir
+                             , os.path.join(deploy_dir, INDEX_FILENAME)
+                             , dirs.get("include")
+                             , dirs.get("exclude")
+                             )
+        try:
+            if value == "all":
+                selected = index.files()
+            elif value.startswith("kind:"):
+                selected = index.select(kind=value[len("kind:"):])
+            elif value.startswith("label:"):
+                labels = {}
+                for pair in value[len("label:"):].split(","):
+                    if "=" not in pair:
+                        self.fail('{pair} is not a key=value label'.format(pair=pair), param, ctx)
+                    key, label = pair.split("=", 1)
+                    labels[key.strip()] = label.strip()
+                selected = index.select(labels=labels)
+            else:
+                found = index.resolve(value)
+                if found is False:
+                    self.fail('{deploy} matches several files in {dir}, use its full path'.format(
+                            deploy=value, dir=kube_dir), param, ctx)
+                if found is None:
+                    self.fail('There is no {deploy} file in {filename}'.format(
+                            deploy=value, filename=kube_dir), param, ctx)
 
-                            if "modifications" in deployment:
-                                mods = deployment["modifications"]
-                            else:
-                                mods = None
+                return self.kube_file(config, found)
+        finally:
+            index.save()
 
-                            deployments.append({ "name": deployment["name"]
-                                               , "path": os.path.join(deploy_dir, deployment["name"], item)
-                                               , "modifications": mods
-                                               })
+        if not selected:
+            self.fail('No files in {dir} match {value}'.format(dir=kube_dir, value=value), param, ctx)
 
-                        files.append({"src":source_item, "deployments":deployments})
+        return {"all": [self.kube_file(config, rel_path) for rel_path in selected]}
 
-                if value == "all":
-                    return {"all":files}
 
-                found = None
-                for file in files:
-                    base = os.path.basename(file["src"])
-                    if base == value or base.replace(".yaml", "") == value:
-                        found = file
-                        break
+    def kube_file(self, config, rel_path):
+        kube_dir = config["kube-env"]["dirs"]["kubernetes-configs"]
+        deploy_dir = config["kube-env"]["dirs"]["deployments"]
 
-                if found is None:
-                    self.fail('There is no {deploy} file in {filename}'.format(
-                            deploy=value, filename=kube_dir), param, ctx)
+        deployments = []
+        for deployment in config["kube-env"]["deployments"]:
+            if "modifications" in deployment:
+                mods = deployment["modifications"]
+            else:
+                mods = None
 
-                return found
+            deployments.append({ "name": deployment["name"]
+                               , "path": os.path.join(deploy_dir, deployment["name"], rel_path)
+                               , "modifications": mods
+                               })
 
-        except IOError:
-            self.fail('There is no {filename}.yaml config in {base}'.format(
-                filename=self.filename, base=self.base_dir), param, ctx)
+        return { "src": os.path.join(kube_dir, rel_path)
+               , "name": rel_path
+               , "deployments": deployments
+               }
 
 
 
@@ -349,7 +590,7 @@ def make_modifications(files, filename, modifications):
         new_base = base.copy()
         for mod_file, mod_locations in modifications.items():
 
-            if mod_file == filename:
+            if mod_file == filename or mod_file == os.path.basename(filename):
                 for location in mod_locations:
 
                     if "where" in location:
@@ -431,9 +672,48 @@ def replace_images(x, images, parent_key=None):
         return x
 
 
-def set_kubernetes_context(env):
-    context = env["kubernetes-context"]
-    subprocess.call("kubectl config use-context {context}".format(context=context), shell=True)
+def kubectl(env, *args):
+    """
+    Build a kubectl command line pinned to ENV's context, leaving the
+    current context in the user's kubeconfig untouched.
+    """
+    return ["kubectl", "--context", env["kubernetes-context"]] + list(args)
+
+
+WORKLOAD_KINDS = [ "Deployment"
+                 , "StatefulSet"
+                 , "DaemonSet"
+                 , "ReplicaSet"
+                 , "ReplicationController"
+                 , "Job"
+                 ]
+
+# Kinds applied together, in order; anything not listed (custom resources
+# and kinds nothing else depends on) goes in a final wave after the workloads.
+APPLY_WAVES = [ [ "Namespace"
+                , "CustomResourceDefinition"
+                ]
+              , [ "ServiceAccount"
+                , "Role"
+                , "ClusterRole"
+                , "RoleBinding"
+                , "ClusterRoleBinding"
+                , "ConfigMap"
+                , "Secret"
+                , "StorageClass"
+                , "PersistentVolume"
+                , "PersistentVolumeClaim"
+                , "ResourceQuota"
+                , "LimitRange"
+                , "PriorityClass"
+                , "PodSecurityPolicy"
+                ]
+              , [ "Service"
+                ]
+              , WORKLOAD_KINDS + [ "CronJob"
+                                 , "Pod"
+                                 ]
+              ]
 
 
 def semVer(tag):
@@ -590,6 +870,43 @@ def tag(image, version_type):
 
 
 
+def generate_file(kubeconfig, deploy, images):
+    """
+    Render KUBECONFIG into DEPLOY's path one document at a time, so only the
+    document being modified is held in memory however large the file is.
+    """
+    if not os.path.exists(os.path.dirname(deploy["path"])):
+        os.makedirs(os.path.dirname(deploy["path"]))
+
+    # Render next to the target and move it into place only once complete,
+    # so a failed or interrupted render never leaves a truncated manifest.
+    tmp_path = deploy["path"] + ".tmp"
+    try:
+        with open(kubeconfig["src"]) as SRC:
+            with open(tmp_path, "w") as TARGET:
+                first = True
+                for doc in yaml.load_all(SRC):
+                    if doc is None:
+                        continue
+
+                    if deploy["modifications"] is not None:
+                        doc = make_modifications( [doc]
+                                                , kubeconfig["name"]
+                                                , deploy["modifications"]
+                                                )[0]
+                    doc = replace_images(doc, images)
+
+                    if not first:
+                        TARGET.write("---\n")
+                    yaml.dump(doc, TARGET, default_flow_style=False, indent=4)
+                    first = False
+        os.rename(tmp_path, deploy["path"])
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
 @click.command()
 @click.argument("env", type=KubeEnv())
 @click.argument("kubefile", type=KubeFile())
@@ -605,136 +922,369 @@ def generate(env, kubefile):
         for kubeconfig in kubefile["all"]:
             for deploy in kubeconfig["deployments"]:
                 if deploy["name"] == env["name"]:
-                    with open(kubeconfig["src"]) as SRC:
-                        if not os.path.exists(os.path.dirname(deploy["path"])):
-                            os.makedirs(os.path.dirname(deploy["path"]))
-                        with open(deploy["path"], "w") as TARGET:
-                            if deploy["modifications"] is not None:
-
-                                src_content = SRC.read().split('---')
-                                
-                                parsed = []
-                                for src in src_content:
-                                    parsed.append(yaml.load(src))
-                                
-                                modded = make_modifications( parsed
-                                                           , os.path.basename(kubeconfig["src"])
-                                                           , deploy["modifications"]
-                                                           )
-                                with_images = replace_images(modded, images)
-
-                                as_yaml = []
-                                for doc in with_images:
-                                    as_yaml.append(yaml.dump(doc, default_flow_style=False, indent=4))
-
-                                TARGET.write("---\n".join(as_yaml))
-                            else:
-                                src_content = SRC.read().split('---')
-                                parsed = []
-                                for src in src_content:
-                                    parsed.append(yaml.load(src))
-                                
-                                with_images = replace_images(parsed, images)
-
-                                as_yaml = []
-                                for doc in with_images:
-                                    as_yaml.append(yaml.dump(doc, default_flow_style=False, indent=4))
-
-                                TARGET.write("---\n".join(as_yaml))
+                    generate_file(kubeconfig, deploy, images)
 
     else:
         for deploy in kubefile["deployments"]:
             if deploy["name"] == env["name"]:
-                with open(kubefile["src"]) as SRC:
-                    if not os.path.exists(os.path.dirname(deploy["path"])):
-                        os.makedirs(os.path.dirname(deploy["path"]))
-                    with open(deploy["path"], "w") as TARGET:
+                generate_file(kubefile, deploy, images)
+
+
+
+
+def get_deploy_paths(env, kubefile):
+    if "all" in kubefile:
+        files = kubefile["all"]
+    else:
+        files = [kubefile]
+
+    paths = []
+    for file in files:
+        for deploy in file["deployments"]:
+            if deploy["name"] == env["name"]:
+                paths.append(deploy["path"])
+    return paths
 
-                        if deploy["modifications"] is not None:
-                            src_content = SRC.read().split('---')
-                            parsed = []
-                            for src in src_content:
-                                parsed.append(yaml.load(src))
-                            
-                            modded = make_modifications( parsed
-                                                       , os.path.basename(kubefile["src"])
-                                                       , deploy["modifications"]
-                                                       )
-                            with_images = replace_images(modded, images)
 
-                            as_yaml = []
-                            for doc in with_images:
-                                as_yaml.append(yaml.dump(doc, default_flow_style=False, indent=4))
+def plan_waves(paths):
+    """
+    Group the objects in the generated files at PATHS into apply waves by
+    kind. Waves hold (path, document index) pairs in file and document
+    order; documents are only loaded again when their wave is applied.
+    """
+    waves = [[] for _ in range(len(APPLY_WAVES) + 1)]
+    for deploy_path in paths:
+        with open(deploy_path) as GENERATED:
+            for index, doc in enumerate(yaml.load_all(GENERATED)):
+                if not isinstance(doc, dict):
+                    continue
+
+                wave = len(APPLY_WAVES)
+                for i, kinds in enumerate(APPLY_WAVES):
+                    if doc.get("kind") in kinds:
+                        wave = i
+                        break
+                waves[wave].append((deploy_path, index))
+    return [wave for wave in waves if wave]
 
-                            TARGET.write("---\n".join(as_yaml))
-                        else:
 
-                            src_content = SRC.read().split('---')
-                            parsed = []
-                            for src in src_content:
-                                parsed.append(yaml.load(src))
-                            
-                            with_images = replace_images(parsed, images)
+def load_wave(wave):
+    """
+    Yield the documents of WAVE, streaming each of its files once.
+    """
+    grouped = []
+    for deploy_path, index in wave:
+        if not grouped or grouped[-1][0] != deploy_path:
+            grouped.append((deploy_path, set()))
+        grouped[-1][1].add(index)
 
-                            as_yaml = []
-                            for doc in with_images:
-                                as_yaml.append(yaml.dump(doc, default_flow_style=False, indent=4))
+    for deploy_path, indexes in grouped:
+        with open(deploy_path) as GENERATED:
+            for index, doc in enumerate(yaml.load_all(GENERATED)):
+                if index in indexes:
+                    yield doc
 
-                            TARGET.write("---\n".join(as_yaml))
 
+def apply_object(env, doc):
+    try:
+        proc = subprocess.Popen( kubectl(env, "apply", "-f", "-")
+                               , stdin=subprocess.PIPE
+                               , stdout=subprocess.PIPE
+                               , stderr=subprocess.STDOUT
+                               , universal_newlines=True
+                               )
+        out, _ = proc.communicate(yaml.dump(doc, default_flow_style=False))
+    except OSError as err:
+        return False, "could not run kubectl: {err}\n".format(err=err)
+    return proc.returncode == 0, out
+
+
+def apply_env(env, kubefile, wave_jobs=8):
+    """
+    Apply the generated KUBEFILE for ENV wave by wave, up to WAVE_JOBS
+    objects at a time, stopping at the first wave with a failure.
+    Returns (succeeded, output) so several environments can be applied
+    side by side and reported separately.
+    """
+    paths = get_deploy_paths(env, kubefile)
+    missing = [p for p in paths if not os.path.exists(p)]
+    if missing:
+        return False, "not generated, run generate first: {missing}\n".format(missing=", ".join(missing))
 
+    try:
+        waves = plan_waves(paths)
+    except (yaml.YAMLError, IOError, OSError) as err:
+        return False, "could not read generated files: {err}\n".format(err=err)
+    if not waves:
+        return True, ""
+
+    # A document is loaded only once a slot is free, so a wave keeps at most
+    # WAVE_JOBS objects in flight plus the one about to be submitted.
+    slots = threading.Semaphore(wave_jobs)
+
+    def apply_slot(doc):
+        try:
+            return apply_object(env, doc)
+        finally:
+            slots.release()
+
+    output = []
+    pool = ThreadPool(min(wave_jobs, max(len(wave) for wave in waves)))
+    try:
+        for i, wave in enumerate(waves):
+            pending = []
+            try:
+                for doc in load_wave(wave):
+                    slots.acquire()
+                    pending.append(pool.apply_async(apply_slot, (doc,)))
+            except (yaml.YAMLError, IOError, OSError) as err:
+                output.extend([p.get()[1] for p in pending])
+                output.append("could not read generated files: {err}\n".format(err=err))
+                return False, "".join(output)
+
+            results = [p.get() for p in pending]
+            output.extend([out for _, out in results])
+
+            if not all(succeeded for succeeded, _ in results):
+                skipped = len(waves) - i - 1
+                if skipped:
+                    output.append("not applying the remaining {skipped} wave(s)\n".format(skipped=skipped))
+                return False, "".join(output)
+    finally:
+        pool.close()
+        pool.join()
+    return True, "".join(output)
 
 
 @click.command()
-@click.argument("env", type=KubeEnv())
+@click.option("--envs", type=KubeEnvList(), default=None,
+              help="Comma separated environments to apply to concurrently.")
+@click.option("--jobs", type=click.IntRange(1), default=4,
+              help="Maximum number of environments applied at once.")
+@click.option("--wave-jobs", type=click.IntRange(1), default=8,
+              help="Maximum number of objects applied at once within a wave.")
+@click.argument("env", type=KubeEnv(), nargs=-1)
 @click.argument("kubefile", type=KubeFile())
-def apply(env, kubefile):
+def apply(envs, jobs, wave_jobs, env, kubefile):
     """
-    Switch to an environment listed in kube/kube-env file.
+    Apply generated files to an environment listed in kube/kube-env file.
     apply {environment} {file|all}
+    apply --envs {environment,...} {file|all}
+
+    Objects are applied in waves by kind: Namespaces and CRDs, then RBAC,
+    ConfigMaps and Secrets, then Services, then workloads, then the rest.
     """
+    if envs is not None:
+        if env:
+            raise click.UsageError("give either an environment or --envs, not both")
 
-    set_kubernetes_context(env)
-    if "all" in kubefile:
-        for file in kubefile["all"]:
-            for deploy in file["deployments"]:
-                if deploy["name"] == env["name"]:
-                    if not os.path.exists(deploy["path"]):
-                        while True:
-                            answer = raw_input("{file} does not exist in {env}, generate it? (Y/n)".format(file=os.path.basename, env=env))
-                            if answer.strip() == "n":
-                                return False
-                            elif answer.strip() == "Y":
-                                generate(env, kubefile)
-
-        for file in kubefile["all"]:
-            for deploy in file["deployments"]:
-                if deploy["name"] == env["name"]:
-                    subprocess.call("kubectl apply -f {path};".format(path=deploy["path"]), shell=True)
+        pool = ThreadPool(min(jobs, len(envs)))
+        try:
+            results = pool.map(lambda e: apply_env(e, kubefile, wave_jobs), envs)
+        finally:
+            pool.close()
+            pool.join()
+
+        failed = []
+        for e, (succeeded, output) in zip(envs, results):
+            print("==> {env}: {status}".format(env=e["name"], status="ok" if succeeded else "failed"))
+            print(output, end="")
+            if not succeeded:
+                failed.append(e["name"])
+
+        if failed:
+            raise click.ClickException("apply failed for {envs}".format(envs=", ".join(failed)))
+        return
+
+    if len(env) != 1:
+        raise click.UsageError("give exactly one environment, or several with --envs")
+    env = env[0]
 
+    if "all" in kubefile:
+        files = kubefile["all"]
     else:
+        files = [kubefile]
+
+    images = None
+    for file in files:
+        for deploy in file["deployments"]:
+            if deploy["name"] == env["name"] and not os.path.exists(deploy["path"]):
+                while True:
+                    answer = raw_input("{file} does not exist in {env}, generate it? (Y/n)".format(file=file["name"], env=env["name"]))
+                    if answer.strip() == "n":
+                        return False
+                    elif answer.strip() == "Y":
+                        if images is None:
+                            images = get_images(env)
+                        generate_file(file, deploy, images)
+                        break
 
-        for deploy in kubefile["deployments"]:
-            if deploy["name"] == env["name"]:
-                if not os.path.exists(deploy["path"]):
-                    while True:
-                        answer = raw_input("{file} does not exist in {env}, generate it? (Y/n)".format(file=os.path.basename, env=env))
-                        if answer.strip() == "n":
-                            return False
-                        elif answer.strip() == "Y":
-                            generate(env, kubefile)
+    succeeded, output = apply_env(env, kubefile, wave_jobs)
+    print(output, end="")
+    if not succeeded:
+        raise click.ClickException("apply failed for {env}".format(env=env["name"]))
 
-        for deploy in kubefile["deployments"]:
-            if deploy["name"] == env["name"]:
-                subprocess.call("kubectl apply -f {path};".format(path=deploy["path"]), shell=True)
+
+# Lines held per container before its reader blocks on `kubectl logs`.
+LOG_BUFFER_SIZE = 1000
+
+# Lines printed from one container before moving on to the next.
+LOG_BATCH_SIZE = 50
+
+
+def get_generated_files(env):
+    with open("kube-env.yaml") as KUBEENV:
+        config = yaml.load(KUBEENV.read())
+        config_schema(config)
+
+        env_dir = os.path.join(config["kube-env"]["dirs"]["deployments"], env["name"])
+        if not os.path.isdir(env_dir):
+            return []
+
+        generated = []
+        for root, subdirs, filenames in os.walk(env_dir):
+            subdirs.sort()
+            for item in sorted(filenames):
+                if item.endswith("yaml") or item.endswith("yml"):
+                    generated.append(os.path.join(root, item))
+        return generated
+
+
+def get_workload_selectors(env):
+    """
+    (namespace, label selector) for every workload in ENV's generated files,
+    namespace being None when the manifest leaves it to the context.
+    """
+    selectors = []
+    for generated in get_generated_files(env):
+        with open(generated) as GENERATED:
+            for doc in yaml.load_all(GENERATED):
+                if not isinstance(doc, dict) or doc.get("kind") not in WORKLOAD_KINDS:
+                    continue
+
+                namespace = (doc.get("metadata") or {}).get("namespace")
+                spec = doc.get("spec") or {}
+                selector = spec.get("selector") or {}
+                labels = None
+                if doc["kind"] == "ReplicationController":
+                    labels = selector
+                elif "matchLabels" in selector:
+                    labels = selector["matchLabels"]
+                if not labels:
+                    template = spec.get("template") or {}
+                    labels = (template.get("metadata") or {}).get("labels")
+                if not labels:
+                    continue
+
+                selector = ( namespace
+                           , ",".join(["{key}={value}".format(key=key, value=labels[key]) for key in sorted(labels)])
+                           )
+                if selector not in selectors:
+                    selectors.append(selector)
+    return selectors
+
+
+def get_log_targets(env, selector=None):
+    targets = []
+    for namespace, workload_selector in get_workload_selectors(env):
+        if selector is not None:
+            workload_selector = workload_selector + "," + selector
+
+        args = ["get", "pods", "-l", workload_selector, "-o", "json"]
+        if namespace is not None:
+            args = ["-n", namespace] + args
+
+        try:
+            output = subprocess.check_output(kubectl(env, *args), stderr=subprocess.STDOUT, universal_newlines=True)
+        except subprocess.CalledProcessError as err:
+            raise click.ClickException("could not list pods for {selector}: {output}".format(
+                    selector=workload_selector, output=err.output.strip()))
+        except OSError as err:
+            raise click.ClickException("could not run kubectl: {err}".format(err=err))
+
+        for pod in json.loads(output)["items"]:
+            for container in pod["spec"]["containers"]:
+                target = (pod["metadata"].get("namespace", namespace), pod["metadata"]["name"], container["name"])
+                if target not in targets:
+                    targets.append(target)
+    return targets
+
+
+def pump_log(proc, lines):
+    for line in iter(proc.stdout.readline, ""):
+        lines.put(line.rstrip("\n"))
+    proc.stdout.close()
+    lines.put(None)
+
+
+def tail_logs(env, targets, buffer_size=LOG_BUFFER_SIZE, batch_size=LOG_BATCH_SIZE):
+    """
+    Follow the logs of every (namespace, pod, container) in TARGETS at once.
+    Each container gets its own bounded buffer, and the buffers are drained
+    round robin a batch at a time, so a chatty container is throttled by
+    back pressure on its `kubectl logs` pipe instead of crowding out the rest.
+    """
+    streams = []
+    procs = []
+    for namespace, pod, container in targets:
+        args = ["logs", "-f", pod, "-c", container]
+        prefix = "[{pod}/{container}]".format(pod=pod, container=container)
+        if namespace is not None:
+            args = ["-n", namespace] + args
+            prefix = "[{namespace}/{pod}/{container}]".format(namespace=namespace, pod=pod, container=container)
+
+        proc = subprocess.Popen( kubectl(env, *args)
+                               , stdout=subprocess.PIPE
+                               , stderr=subprocess.STDOUT
+                               , universal_newlines=True
+                               )
+        lines = queue.Queue(maxsize=buffer_size)
+        reader = threading.Thread(target=pump_log, args=(proc, lines))
+        reader.daemon = True
+        reader.start()
+
+        procs.append(proc)
+        streams.append((prefix, lines))
+
+    try:
+        while streams:
+            idle = True
+            for stream in list(streams):
+                prefix, lines = stream
+                for _ in range(batch_size):
+                    try:
+                        line = lines.get_nowait()
+                    except queue.Empty:
+                        break
+                    idle = False
+                    if line is None:
+                        streams.remove(stream)
+                        break
+                    print(prefix, line)
+            if idle:
+                time.sleep(0.05)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
 
 
 @click.command()
-def logs():
+@click.argument("env", type=KubeEnv())
+@click.argument("selector", required=False)
+def logs(env, selector):
     """
-    Switch to an environment listed in kube/kube-env file.
+    Tail the logs of every pod behind an environment's generated workloads.
+    logs {environment} [selector]
     """
-    pass
+    targets = get_log_targets(env, selector)
+    if not targets:
+        print("no running pods found for {env}".format(env=env["name"]))
+        return False
+
+    tail_logs(env, targets)
 
 
 
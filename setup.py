@@ -17,6 +17,7 @@ setup(
         push=kubeenv:push
         tag=kubeenv:tag
         generate=kubeenv:generate
+        logs=kubeenv:logs
         
     ''',
 )